@@ -22,6 +22,8 @@ You should have received a copy of the GNU Lesser General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
+import fnmatch
+
 
 class MockRedis(object):
     """A mock-redis object for quick offline tests."""
@@ -74,6 +76,12 @@ class MockRedis(object):
         else:
             return False
 
+    def exists(self, key):
+        return key in self.data
+
+    def expire(self, key, seconds):
+        return key in self.data
+
     def hget(self, key, hkey):
         if key in self.data and hkey in self.data[key]:
             return self.data[key][hkey]
@@ -89,7 +97,7 @@ class MockRedis(object):
 
     def hgetall(self, key):
         if key in self.data:
-            return self.data[key]
+            return dict(self.data[key])
         return {}
 
     def hdel(self, key, hkey):
@@ -109,6 +117,11 @@ class MockRedis(object):
         self.data[key][member] = 1
         return True
 
+    def smembers(self, key):
+        if key in self.data:
+            return set(self.data[key].keys())
+        return set()
+
     def srem(self, key, member):
         if key in self.data and member in self.data[key]:
             del self.data[key][member]
@@ -128,3 +141,69 @@ class MockRedis(object):
 
     def lpop(self, key):
         return self.data[key].pop(0)
+
+    def hsetnx(self, key, hkey, val):
+        if key in self.data and hkey in self.data[key]:
+            return False
+        return self.hset(key, hkey, val)
+
+    def scan_iter(self, match=None):
+        for key in list(self.data.keys()):
+            if match is None or fnmatch.fnmatchcase(key, match):
+                yield key
+
+    def xadd(self, name, fields, id='*', maxlen=None, approximate=True):
+        if name not in self.data:
+            self.data[name] = []
+        if id == '*':
+            id = '%d-0' % (len(self.data[name]) + 1)
+        self.data[name].append((id, dict(fields)))
+        if maxlen is not None:
+            del self.data[name][:-maxlen]
+        return id
+
+    def xrevrange(self, name, max='+', min='-', count=None):
+        entries = list(reversed(self.data.get(name, [])))
+        if count is not None:
+            entries = entries[:count]
+        return entries
+
+    def pipeline(self, transaction=True):
+        return MockPipeline(self)
+
+
+class MockPipeline(object):
+    """A mock pipeline, queueing commands between multi() and execute()."""
+
+    def __init__(self, redis):
+        self.redis = redis
+        self.queue = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.reset()
+
+    def watch(self, *keys):
+        return True
+
+    def multi(self):
+        self.queue = []
+
+    def reset(self):
+        self.queue = None
+
+    def execute(self):
+        queue, self.queue = self.queue or [], None
+        return [method(*args, **kwargs) for method, args, kwargs in queue]
+
+    def __getattr__(self, name):
+        method = getattr(self.redis, name)
+        if self.queue is None:
+            return method
+
+        def queued(*args, **kwargs):
+            self.queue.append((method, args, kwargs))
+            return self
+        return queued
@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+
+"""
+Classes for spreading the pdns.* keyspace across several Redis servers
+using client-side consistent hashing.
+"""
+
+__copyright__ = """
+pdns-redis.py, Copyright 2011, Bjarni R. Einarsson <http://bre.klaki.net/>
+                               and The Beanstalks Project ehf.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Lesser General Public License as published
+by the Free Software Foundation, either version 3 of the License, or (at
+your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import bisect
+import hashlib
+import time
+
+from redis import WatchError
+
+RING_REPLICAS = 160
+ZONE_LABELS = 2
+RESHARD_BATCH = 100
+RESHARD_PAUSE = 0.1  # seconds
+TOMBSTONE_PREFIX = 'pdns-deleted.'
+TOMBSTONE_ALL = '*'
+TOMBSTONE_TTL = 60 * 60 * 24  # seconds
+QUERY_COUNTER = 'TXT\tQC'
+
+
+def ShardKey(domain, zone_labels=ZONE_LABELS):
+    """Return the part of a domain name used to pick a shard.
+
+    This is the last zone_labels labels of the domain, so foo.domain.com,
+    *.domain.com and domain.com all land on the same server and wild-card
+    lookups never need to leave it.  Note that this puts every zone under a
+    multi-label suffix such as co.uk on a single server, unless zone_labels
+    is raised to match.
+    """
+    labels = domain.lower().rstrip('.').split('.')
+    if labels[0] == '*' and len(labels) > 1:
+        labels = labels[1:]
+    return '.'.join(labels[-zone_labels:])
+
+
+class HashRing(object):
+    """A consistent hash ring mapping shard keys to node names."""
+
+    def __init__(self, nodes, replicas=RING_REPLICAS):
+        self.nodes = list(nodes)
+        self.ring = []
+        for node in self.nodes:
+            for i in range(0, replicas):
+                self.ring.append((self.Hash('%s#%d' % (node, i)), node))
+        self.ring.sort()
+        self.points = [point for point, node in self.ring]
+
+    def Hash(self, key):
+        if not isinstance(key, bytes):
+            key = key.encode('utf-8')
+        return int(hashlib.md5(key).hexdigest()[:8], 16)
+
+    def GetNode(self, key):
+        if not self.ring:
+            return None
+        idx = bisect.bisect(self.points, self.Hash(key)) % len(self.ring)
+        return self.ring[idx][1]
+
+
+class ShardedRedis(object):
+    """Route pdns.* hash operations to one of several Redis servers.
+
+    The backends argument is a dict of node name (host:port) to Redis-like
+    objects.  If previous is given, it should be the ShardedRedis for the
+    old layout.  While a key's node differs between the two layouts, reads
+    merge the old and new hashes (new wins) and deletions are recorded as
+    tombstones on the new node, so the cluster can be served while
+    Reshard() is moving keys around.
+    """
+
+    def __init__(self, backends, prefix, zone_labels=ZONE_LABELS,
+                 previous=None):
+        self.backends = backends
+        self.prefix = prefix
+        self.zone_labels = zone_labels
+        self.previous = previous
+        self.ring = HashRing(sorted(backends.keys()))
+
+    def NodeName(self, key):
+        domain = key[len(self.prefix):] if key.startswith(self.prefix) else key
+        return self.ring.GetNode(ShardKey(domain, self.zone_labels))
+
+    def Node(self, key):
+        return self.backends[self.NodeName(key)]
+
+    def Moved(self, key):
+        """Return the old backend for key, if it lives elsewhere now."""
+        if not self.previous:
+            return None
+        if self.previous.NodeName(key) == self.NodeName(key):
+            return None
+        return self.previous.Node(key)
+
+    def TombstoneKey(self, key):
+        return TOMBSTONE_PREFIX + key[len(self.prefix):]
+
+    def Tombstone(self, be, key, hkeys=None):
+        """Record on be that hkeys (or all of key) should not be moved.
+
+        Tombstones are only written while the old server still holds the
+        key, and expire after TOMBSTONE_TTL, so they cannot outlive the
+        reshard they were written for.
+        """
+        old = self.Moved(key)
+        if old is None or not old.exists(key):
+            return
+        for hkey in (hkeys is None and [TOMBSTONE_ALL] or hkeys):
+            be.sadd(self.TombstoneKey(key), hkey)
+        be.expire(self.TombstoneKey(key), TOMBSTONE_TTL)
+
+    def Deleted(self, key):
+        return self.Node(key).smembers(self.TombstoneKey(key))
+
+    def ping(self):
+        for be in self.backends.values():
+            be.ping()
+        if self.previous:
+            self.previous.ping()
+        return True
+
+    def exists(self, key):
+        if self.Node(key).exists(key):
+            return True
+        return bool(self.Moved(key) is not None and self.hgetall(key))
+
+    def hget(self, key, hkey):
+        rv = self.Node(key).hget(key, hkey)
+        old = self.Moved(key)
+        if old is None or (rv is not None and hkey != QUERY_COUNTER):
+            return rv
+
+        deleted = self.Deleted(key)
+        if hkey in deleted or TOMBSTONE_ALL in deleted:
+            return rv
+        old_rv = old.hget(key, hkey)
+        if rv is None:
+            return old_rv
+        if old_rv is not None:
+            rv = str(int(rv) + int(old_rv))
+        return rv
+
+    def hgetall(self, key):
+        rv = self.Node(key).hgetall(key)
+        old = self.Moved(key)
+        if old is None:
+            return rv
+
+        merged = {}
+        deleted = self.Deleted(key)
+        if TOMBSTONE_ALL not in deleted:
+            for hkey, val in old.hgetall(key).items():
+                if hkey not in deleted:
+                    merged[hkey] = val
+        if QUERY_COUNTER in merged and QUERY_COUNTER in rv:
+            rv = dict(rv)
+            rv[QUERY_COUNTER] = str(int(rv[QUERY_COUNTER]) +
+                                    int(merged[QUERY_COUNTER]))
+        merged.update(rv)
+        return merged
+
+    def hincrby(self, key, hkey, val):
+        return self.Node(key).hincrby(key, hkey, val)
+
+    def hset(self, key, hkey, val):
+        return self.Node(key).hset(key, hkey, val)
+
+    def hdel(self, key, hkey):
+        old = self.Moved(key)
+        self.Tombstone(self.Node(key), key, [hkey])
+        rv = self.Node(key).hdel(key, hkey)
+        if old is not None:
+            rv = old.hdel(key, hkey) or rv
+        return rv
+
+    def delete(self, key):
+        old = self.Moved(key)
+        self.Tombstone(self.Node(key), key)
+        rv = self.Node(key).delete(key)
+        if old is not None:
+            rv = old.delete(key) or rv
+        return rv
+
+
+def Reshard(old, new, batch=RESHARD_BATCH, pause=RESHARD_PAUSE):
+    """Move keys from the old layout to the new one, a batch at a time.
+
+    Fields are copied with HSETNX so anything written to the new server
+    since the move started wins, except for the query counter which is
+    added to the new server's count.  Tombstoned fields are skipped so
+    deletions made meanwhile stay deleted.  Servers using a ShardedRedis
+    with previous=old keep answering correctly while this runs.  Once all
+    keys have moved the tombstones are removed.  Returns the number of keys
+    moved.
+    """
+    moved = 0
+    for name in sorted(old.backends.keys()):
+        src = old.backends[name]
+        pending = []
+        for key in src.scan_iter(match=old.prefix + '*'):
+            if new.NodeName(key) != name:
+                pending.append(key)
+            if len(pending) >= batch:
+                moved += _MoveKeys(src, new, pending)
+                pending = []
+                time.sleep(pause)
+        moved += _MoveKeys(src, new, pending)
+
+    for be in new.backends.values():
+        for key in list(be.scan_iter(match=TOMBSTONE_PREFIX + '*')):
+            be.delete(key)
+    return moved
+
+
+def _MoveKeys(src, new, keys):
+    for key in keys:
+        _MoveKey(src, new, key)
+    return len(keys)
+
+
+def _MoveKey(src, new, key):
+    """Copy key to its new node and delete it from src.
+
+    The source key and the destination tombstones are WATCHed, so a client
+    deletion landing part way through makes us start over rather than copy
+    a deleted field back.
+    """
+    dst = new.Node(key)
+    tombstones = new.TombstoneKey(key)
+    counted = 0
+    with src.pipeline() as spipe:
+        with dst.pipeline() as dpipe:
+            while True:
+                try:
+                    spipe.watch(key)
+                    fields = spipe.hgetall(key)
+                    dpipe.watch(tombstones)
+                    deleted = dpipe.smembers(tombstones)
+                    dpipe.multi()
+                    count = 0
+                    if TOMBSTONE_ALL not in deleted:
+                        for hkey, val in fields.items():
+                            if hkey == QUERY_COUNTER:
+                                count = int(val)
+                            elif hkey not in deleted:
+                                dpipe.hsetnx(key, hkey, val)
+                    # Only add what an earlier attempt has not.
+                    if count != counted:
+                        dpipe.hincrby(key, QUERY_COUNTER, count - counted)
+                    dpipe.execute()
+                    counted = count
+                    spipe.multi()
+                    spipe.delete(key)
+                    spipe.execute()
+                    return
+                except WatchError:
+                    continue
@@ -10,12 +10,16 @@ and deleting DNS records in Redis.
 Usage: pdns-redis.py [-R <host:port>] [-A <password-file>] [-P]
        pdns-redis.py [-R <host:port>] [-A <password-file>]
                      [-D <domain>] [-r <type>] [-d <data>] [-k] [-q] [-a <ttl>]
+       pdns-redis.py -S <host:port,...> -O <host:port,...> [-A <pw-file>] -X
 
 Flags:
 
   -R <host:port>     Set the Redis back-end.
   -W <host:port>     Set the Redis back-end for writes.
   -A <password-file> Read a Redis password from the named file.
+  -S <host:port,...> Shard domains across several Redis back-ends.
+  -O <host:port,...> The previous shard list, while resharding.
+  -X                 Move keys from the -O shards to the -S shards.
   -P                 Run as a PowerDNS pipe-backend.
   -w                 Enable wild-card lookups in PowerDNS pipe-backend.
   -D <domain>        Select a domain for -q or -a.
@@ -38,9 +42,22 @@ Note that arguments are processed in order so multiple adds and deletes can
 be done at once, just by repeating the -D, -r, -d, -k and -a arguments, varying
 the data as you go along.
 
+Consecutive adds and deletes are committed together in a single MULTI/EXEC
+transaction, which also appends a change record to the pdns-journal stream.
+Each record's ID is <serial>-0, where serial is the value of pdns-serial, so
+readers can follow changes with XREAD instead of rescanning the database.
+
 Domain entries starting with a '*', for example *.foo.com, will be treated as
 wild-card entries by the PowerDNS pipe-backend, if the -w flag precedes -P.
 
+When -S is given, -R and -W are ignored and each domain is stored on one of
+the listed servers, chosen by consistent hashing of its last two labels, so a
+zone and its wild-cards always share a server.  All zones under a multi-label
+suffix such as co.uk therefore share one server.  To change the shard list,
+run all readers and writers with the new list as -S and the old one as -O,
+then run -X once; until a domain has moved, lookups merge its records from
+both servers.  Drop -O once -X has finished.
+
 Examples:
 
   # Configure an A and two MX records for domain.com.
@@ -65,6 +82,9 @@ Examples:
   pdns-redis.py -R localhost:9076 -P
   pdns-redis.py -R localhost:9076 -w -P  # Now with wildcard domains!
 
+  # Grow a two server cluster to three servers
+  pdns-redis.py -S r1:6379,r2:6379,r3:6379 -O r1:6379,r2:6379 -X
+
 """
 
 __copyright__ = """
@@ -87,21 +107,23 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 BANNER = "pdns-redis.py, by Bjarni R. Einarsson"
 
+import getopt
 import re
 import redis
 import socket
 import sys
 import time
 import urllib
-import argparse
 import logging
 from PyPdnsRedis.mock import MockRedis
+from PyPdnsRedis.sharding import ShardedRedis, Reshard
 
-OPT_COMMON_FLAGS = 'A:R:W:z'
-OPT_COMMON_ARGS = ['auth=', 'redis=', 'redis_write=', 'reset']
-OPT_FLAGS = 'PwD:r:d:kqa:'
+OPT_COMMON_FLAGS = 'A:R:W:S:O:z'
+OPT_COMMON_ARGS = ['auth=', 'redis=', 'redis_write=', 'shards=', 'old_shards=',
+                   'reset']
+OPT_FLAGS = 'PwD:r:d:kqa:X'
 OPT_ARGS = ['pdnsbe', 'domain', 'record', 'data', 'kill', 'delete', 'query',
-            'add']
+            'add', 'reshard']
 
 VALID_RECORDS = ['A', 'AAAA', 'NS', 'MX', 'CNAME', 'SOA', 'TXT']
 TTL_SUFFIXES = {
@@ -114,6 +136,10 @@ MAGIC_SELF_IP = 'self'
 MAGIC_TEST_VALIDITY = 60  # seconds
 
 REDIS_PREFIX = 'pdns.'
+JOURNAL_KEY = 'pdns-journal'
+JOURNAL_SERIAL = 'pdns-serial'
+JOURNAL_MAXLEN = 100000
+WRITE_BATCH_SIZE = 100
 
 
 class Error(Exception):
@@ -210,28 +236,71 @@ class QueryOp(Task):
 
 
 class WriteOp(QueryOp):
+    """Write operations are committed in batches by WriteBatch."""
+
     def BE(self):
         return self.redis_pdns.WBE()
 
+    def Key(self):
+        return REDIS_PREFIX + self.domain
+
+    def NeedsQuery(self):
+        """True if Prepare reads from Redis."""
+        return False
+
+    def Prepare(self, be):
+        """Read whatever Queue needs, once the batch's keys are WATCHed."""
+        pass
+
+    def Queue(self, pipe):
+        """Queue writes on pipe, returning one journal line per change."""
+        return []
+
+    def Report(self):
+        return "Report not implemented! Woah!"
+
+    def Run(self):
+        return WriteBatch(self.redis_pdns, [self]).Run()
+
 
 class DeleteOp(WriteOp):
     """This object will delete records from Redis."""
 
-    def Run(self):
+    def __init__(self, redis_pdns, domain, record=None, data=None):
+        QueryOp.__init__(self, redis_pdns, domain, record, data)
+        self.fields = None
+        self.found = False
+
+    def NeedsQuery(self):
+        return True
+
+    def Prepare(self, be):
         if not self.record and not self.data:
-            self.BE().delete(REDIS_PREFIX + self.domain)
-            return 'Deleted all records for %s.' % self.domain
+            self.found = bool(be.exists(self.Key()))
+            return
+
+        self.fields = []
+        for entry in be.hgetall(self.Key()):
+            record, data = entry.split("\t", 1)
+            if ((not self.record or record == self.record) and
+                    (not self.data or data == self.data)):
+                self.fields.append(entry)
+
+    def Queue(self, pipe):
+        if self.fields is None:
+            if not self.found:
+                return []
+            pipe.delete(self.Key())
+            return ['DEL\t%s' % self.domain]
 
-        deleted = 0
-        if self.record and self.data:
-            deleted += self.BE().hdel(REDIS_PREFIX + self.domain,
-                                      "\t".join([self.record, self.data]))
-        else:
-            for record in self.Query():
-                deleted += self.BE().hdel(REDIS_PREFIX + self.domain,
-                                          "\t".join([record[1], record[3]]))
+        for field in self.fields:
+            pipe.hdel(self.Key(), field)
+        return ['DEL\t%s\t%s' % (self.domain, field) for field in self.fields]
 
-        return 'Deleted %d records from %s.' % (deleted, self.domain)
+    def Report(self):
+        if self.fields is None:
+            return 'Deleted all records for %s.' % self.domain
+        return 'Deleted %d records from %s.' % (len(self.fields), self.domain)
 
 
 class AddOp(WriteOp):
@@ -251,12 +320,113 @@ class AddOp(WriteOp):
         else:
             self.ttl = str(int(ttl))
 
-    def Run(self):
-        self.BE().hset(REDIS_PREFIX + self.domain,
-                       "\t".join([self.record, self.data]), self.ttl)
+    def Queue(self, pipe):
+        pipe.hset(self.Key(), "\t".join([self.record, self.data]), self.ttl)
+        return ['ADD\t%s\t%s\t%s\t%s' % (self.domain, self.record,
+                                          self.data, self.ttl)]
+
+    def Report(self):
         return 'Added %s record to %s.' % (self.record, self.domain)
 
 
+class WriteBatch(Task):
+    """This object will commit a batch of WriteOps and journal them.
+
+    Each Redis server touched gets one MULTI/EXEC transaction, which bumps
+    its pdns-serial counter and appends the changes to its pdns-journal
+    stream with an ID of <serial>-0.  Batches which change nothing are not
+    journaled.
+    """
+
+    def __init__(self, redis_pdns, ops):
+        self.redis_pdns = redis_pdns
+        self.ops = ops
+
+    def NextSerial(self, pipe):
+        # Never reuse an ID, even if pdns-serial was reset or deleted.
+        serial = int(pipe.get(JOURNAL_SERIAL) or 0)
+        last = pipe.xrevrange(JOURNAL_KEY, count=1)
+        if last:
+            serial = max(serial, int(last[0][0].split('-')[0]))
+        return serial + 1
+
+    def Commit(self, be, ops):
+        wbe = self.redis_pdns.WBE()
+        with be.pipeline() as pipe:
+            while True:
+                try:
+                    pipe.watch(JOURNAL_SERIAL, JOURNAL_KEY,
+                               *[op.Key() for op in ops])
+                    for op in ops:
+                        op.Prepare(wbe)
+                    serial = self.NextSerial(pipe)
+
+                    pipe.multi()
+                    changes = []
+                    for op in ops:
+                        changes.extend(op.Queue(pipe))
+                    if not changes:
+                        pipe.reset()
+                        return
+
+                    if isinstance(wbe, ShardedRedis):
+                        # Keys may still be on the old shards, mid-reshard.
+                        for op in ops:
+                            if (isinstance(op, DeleteOp) and
+                                    wbe.Moved(op.Key()) is not None):
+                                wbe.Tombstone(pipe, op.Key(), op.fields)
+
+                    pipe.set(JOURNAL_SERIAL, serial)
+                    pipe.xadd(JOURNAL_KEY,
+                              {'serial': serial, 'changes': '\n'.join(changes)},
+                              id='%d-0' % serial, maxlen=JOURNAL_MAXLEN)
+                    pipe.execute()
+                    break
+                except redis.WatchError:
+                    continue
+
+        if isinstance(wbe, ShardedRedis):
+            # Tombstones expire, so also delete any old copy outright.
+            for op in ops:
+                old = wbe.Moved(op.Key())
+                if isinstance(op, DeleteOp) and old is not None:
+                    with old.pipeline() as pipe:
+                        pipe.multi()
+                        op.Queue(pipe)
+                        pipe.execute()
+
+    def Run(self):
+        be = self.redis_pdns.WBE()
+        nodes, groups = [], {}
+        for op in self.ops:
+            node = be
+            if isinstance(be, ShardedRedis):
+                node = be.Node(op.Key())
+            if id(node) not in groups:
+                nodes.append(node)
+                groups[id(node)] = []
+            groups[id(node)].append(op)
+
+        for node in nodes:
+            self.Commit(node, groups[id(node)])
+
+        return '\n'.join([op.Report() for op in self.ops])
+
+
+class ReshardOp(Task):
+    """This object will move keys between two shard layouts."""
+
+    def __init__(self, redis_pdns):
+        if not redis_pdns.redis_shards or not redis_pdns.redis_old_shards:
+            raise ArgumentError('Resharding requires both -S and -O.')
+        self.redis_pdns = redis_pdns
+
+    def Run(self):
+        be = self.redis_pdns.BE()
+        moved = Reshard(be.previous, be)
+        return 'Moved %d domains to new shards.' % moved
+
+
 class PdnsChatter(Task):
     """This object will chat with the pDNS server."""
 
@@ -415,6 +585,8 @@ class PdnsRedis(object):
         self.redis_pass = None
         self.redis_write_host = None
         self.redis_write_port = None
+        self.redis_shards = None
+        self.redis_old_shards = None
         self.be = None
         self.wbe = None
         self.chat_wildcards = False
@@ -443,6 +615,12 @@ class PdnsRedis(object):
             if opt in ('-W', '--redis_write'):
                 self.redis_write_host, self.redis_write_port = arg.split(':')
 
+            if opt in ('-S', '--shards'):
+                self.redis_shards = arg.split(',')
+
+            if opt in ('-O', '--old_shards'):
+                self.redis_old_shards = arg.split(',')
+
             if opt in ('-A', '--auth'):
                 self.redis_pass = self.GetPass(arg)
 
@@ -475,6 +653,9 @@ class PdnsRedis(object):
                 self.tasks.append(AddOp(self,
                                         self.q_domain, self.q_record, self.q_data, arg))
 
+            if opt in ('-X', '--reshard'):
+                self.tasks.append(ReshardOp(self))
+
             if opt in ('-w', ):
                 self.chat_wildcards = True
 
@@ -484,7 +665,26 @@ class PdnsRedis(object):
 
         return self
 
+    def Connect(self, host, port):
+        if host == 'mock':
+            return MockRedis()
+        return redis.Redis(host=host, port=int(port),
+                           password=self.redis_pass)
+
+    def ShardBE(self, shards, previous=None):
+        backends = {}
+        for shard in shards:
+            host, port = shard.split(':')
+            backends[shard] = self.Connect(host, port)
+        return ShardedRedis(backends, REDIS_PREFIX, previous=previous)
+
     def BE(self):
+        if not self.be and self.redis_shards:
+            previous = None
+            if self.redis_old_shards:
+                previous = self.ShardBE(self.redis_old_shards)
+            self.be = self.ShardBE(self.redis_shards, previous=previous)
+            self.be.ping()
         if not self.be:
             if self.redis_host == 'mock':
                 self.be = MockRedis()
@@ -496,7 +696,7 @@ class PdnsRedis(object):
         return self.be
 
     def WBE(self):
-        if not self.redis_write_host:
+        if self.redis_shards or not self.redis_write_host:
             return self.BE()
         if not self.wbe:
             if self.redis_write_host == 'mock':
@@ -514,48 +714,32 @@ class PdnsRedis(object):
             raise ArgumentError('Nothing to do!')
         else:
             self.BE()
+            batch = []
             for task in self.tasks:
-                sys.stdout.write(task.Run().encode('utf-8') + '\n')
+                if isinstance(task, WriteOp):
+                    if task.NeedsQuery() and task.Key() in [
+                            op.Key() for op in batch]:
+                        self.Output(WriteBatch(self, batch).Run())
+                        batch = []
+                    batch.append(task)
+                    if len(batch) < WRITE_BATCH_SIZE:
+                        continue
+                    task, batch = WriteBatch(self, batch), []
+                elif batch:
+                    self.Output(WriteBatch(self, batch).Run())
+                    batch = []
+                self.Output(task.Run())
+            if batch:
+                self.Output(WriteBatch(self, batch).Run())
+
+    def Output(self, text):
+        sys.stdout.write(text.encode('utf-8') + '\n')
 
 
 if __name__ == '__main__':
-    parser = argparse.ArgumentParser()
-    redis_args_group = parser.add_argument_group('Redis Settings')
-    redis_args_group.add_argument(
-        '--redis_server', '-R', default='localhost:6379', help='Redis backend host:port (default: %(default)s)')
-    redis_args_group.add_argument(
-        '--redis_write_server', '-W', default=None, help='Redis write backend (default: %(default)s)')
-    redis_args_group.add_argument(
-        '--redis_password_filename', '-A', default=None, help='Redis password file (default: %(default)s)')
-
-    powerdns_args_group = parser.add_argument_group('PowerDNS backend settings')
-    powerdns_args_group.add_argument(
-        '--pydns_backend', '-P', action='store_true', help='Run as a PowerDNS pipe backend')
-    powerdns_args_group.add_argument(
-        '--enable_wildcard_lookups', '-w', action='store_true', help='Enable PowerDNS wildcard lookups')
-
-    dns_args_group = parser.add_argument_group('Add DNS settings')
-    dns_args_group.add_argument('--domain', '-D', help='Domain name')
-    dns_args_group.add_argument(
-        '--record_type', '-r', choices=VALID_RECORDS, help='Record type')
-    dns_args_group.add_argument('--data', '-d', help='DNS Record value')
-    dns_args_group.add_argument(
-        '--ttl', '-a',
-        help='Add using a given TTL (requires -r and -d).  The TTL is in seconds, but may use a suffix of M, H, D or W '
-             'for minutes, hours, days or weeks respectively.'
-    )
-    dns_args_group.add_argument('--zero', '-z', action='store_true', help='Zero out the record')
-    dns_args_group.add_argument('--delete', '-k', action='store_true', help='Delete (kill) the record')
-
-    args = parser.parse_args()
-    print args
-    sys.exit(0)
     try:
         pr = PdnsRedis().ParseArgs(sys.argv[1:]).RunTasks()
-    except ArgumentError, e:
-        print
-        DOC
-        print
-        'Error: %s' % e
+    except (ArgumentError, getopt.GetoptError), e:
+        print __doc__
+        print 'Error: %s' % e
         sys.exit(1)
-
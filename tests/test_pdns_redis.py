@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+
+"""
+Tests for the batched, journaled write path in scripts/pdns_redis.py, run
+against MockRedis.
+"""
+
+import imp
+import os
+import sys
+import unittest
+from StringIO import StringIO
+
+ROOT = os.path.join(os.path.dirname(__file__), '..')
+sys.path.insert(0, ROOT)
+
+from PyPdnsRedis.mock import MockRedis
+from PyPdnsRedis.sharding import ShardedRedis
+
+pdns_redis = imp.load_source('pdns_redis',
+                             os.path.join(ROOT, 'scripts', 'pdns_redis.py'))
+from pdns_redis import (PdnsRedis, AddOp, DeleteOp, QueryOp, JOURNAL_KEY,
+                        JOURNAL_SERIAL, REDIS_PREFIX, WRITE_BATCH_SIZE)
+
+
+class WriteTest(unittest.TestCase):
+
+    def setUp(self):
+        self.pr = PdnsRedis()
+        self.pr.redis_host = 'mock'
+        self.be = self.pr.BE()
+        self.stdout, sys.stdout = sys.stdout, StringIO()
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+
+    def Run(self, *tasks):
+        self.pr.tasks = list(tasks)
+        self.pr.RunTasks()
+        return sys.stdout.getvalue().splitlines()
+
+    def Journal(self):
+        return [(entry_id, fields['changes'].split('\n'))
+                for entry_id, fields in self.be.data.get(JOURNAL_KEY, [])]
+
+
+class WriteBatchTest(WriteTest):
+
+    def test_consecutive_writes_share_a_batch(self):
+        self.be.hset(REDIS_PREFIX + 'b.com', 'A\t1', '60')
+        output = self.Run(AddOp(self.pr, 'a.com', 'A', '1.2.3.4', '5M'),
+                          AddOp(self.pr, 'a.com', 'MX', '10 mx', '1D'),
+                          DeleteOp(self.pr, 'b.com'))
+        self.assertEqual(output, ['Added A record to a.com.',
+                                  'Added MX record to a.com.',
+                                  'Deleted all records for b.com.'])
+        self.assertEqual(self.Journal(), [
+            ('1-0', ['ADD\ta.com\tA\t1.2.3.4\t300',
+                     'ADD\ta.com\tMX\t10 mx\t86400',
+                     'DEL\tb.com'])])
+        self.assertEqual(self.be.get(JOURNAL_SERIAL), '1')
+
+    def test_batch_size_limit(self):
+        count = WRITE_BATCH_SIZE + 10
+        self.Run(*[AddOp(self.pr, 'd%d.com' % i, 'A', '1', '60')
+                   for i in range(0, count)])
+        self.assertEqual([len(changes) for eid, changes in self.Journal()],
+                         [WRITE_BATCH_SIZE, 10])
+
+    def test_query_splits_batch_on_same_key(self):
+        output = self.Run(AddOp(self.pr, 'a.com', 'A', '1', '60'),
+                          AddOp(self.pr, 'b.com', 'A', '1', '60'),
+                          DeleteOp(self.pr, 'b.com', 'A', None),
+                          DeleteOp(self.pr, 'a.com', 'A', '1'))
+        self.assertEqual(output[2:], ['Deleted 1 records from b.com.',
+                                      'Deleted 1 records from a.com.'])
+        self.assertEqual(self.Journal(), [
+            ('1-0', ['ADD\ta.com\tA\t1\t60', 'ADD\tb.com\tA\t1\t60']),
+            ('2-0', ['DEL\tb.com\tA\t1', 'DEL\ta.com\tA\t1'])])
+
+    def test_queries_split_batch(self):
+        output = self.Run(AddOp(self.pr, 'a.com', 'A', '1', '60'),
+                          QueryOp(self.pr, 'a.com'),
+                          AddOp(self.pr, 'a.com', 'A', '2', '60'))
+        self.assertEqual(output[1], "[('a.com', 'A', '60', '1')]")
+        self.assertEqual([eid for eid, changes in self.Journal()],
+                         ['1-0', '2-0'])
+
+    def test_empty_batch_is_not_journaled(self):
+        output = self.Run(DeleteOp(self.pr, 'a.com', 'A', None),
+                          DeleteOp(self.pr, 'b.com'))
+        self.assertEqual(output, ['Deleted 0 records from a.com.',
+                                  'Deleted all records for b.com.'])
+        self.assertEqual(self.Journal(), [])
+        self.assertEqual(self.be.get(JOURNAL_SERIAL), None)
+
+    def test_delete_all_after_add(self):
+        self.Run(AddOp(self.pr, 'a.com', 'A', '1', '60'),
+                 DeleteOp(self.pr, 'a.com'))
+        self.assertEqual(self.be.hgetall(REDIS_PREFIX + 'a.com'), {})
+        self.assertEqual(self.Journal(), [('1-0', ['ADD\ta.com\tA\t1\t60']),
+                                          ('2-0', ['DEL\ta.com'])])
+
+    def test_delete_does_not_count_queries(self):
+        self.Run(AddOp(self.pr, 'a.com', 'A', '1', '60'),
+                 AddOp(self.pr, 'a.com', 'MX', '10 mx', '60'))
+        self.Run(DeleteOp(self.pr, 'a.com', 'A', None))
+        self.assertEqual(self.be.hgetall(REDIS_PREFIX + 'a.com'),
+                         {'MX\t10 mx': '60'})
+
+    def test_serial_survives_reset(self):
+        self.Run(AddOp(self.pr, 'a.com', 'A', '1', '60'))
+        self.be.delete(JOURNAL_SERIAL)
+        self.Run(AddOp(self.pr, 'a.com', 'A', '2', '60'))
+        self.assertEqual([eid for eid, changes in self.Journal()],
+                         ['1-0', '2-0'])
+        self.assertEqual(self.be.get(JOURNAL_SERIAL), '2')
+
+
+class ParseArgsTest(WriteTest):
+
+    def test_command_line(self):
+        self.pr = PdnsRedis().ParseArgs(['-R', 'mock:0', '-D', 'a.com',
+                                         '-r', 'A', '-d', '1', '-a', '60',
+                                         '-q'])
+        self.pr.RunTasks()
+        self.assertEqual(sys.stdout.getvalue().splitlines(),
+                         ['Added A record to a.com.',
+                          "[('a.com', 'A', '60', '1')]"])
+
+    def test_reshard_command_line(self):
+        self.pr = PdnsRedis().ParseArgs(['-S', 'mock:1,mock:2,mock:3',
+                                         '-O', 'mock:1,mock:2', '-X'])
+        self.pr.RunTasks()
+        self.assertEqual(sys.stdout.getvalue().splitlines(),
+                         ['Moved 0 domains to new shards.'])
+
+    def test_reshard_needs_old_shards(self):
+        self.assertRaises(pdns_redis.ArgumentError, PdnsRedis().ParseArgs,
+                          ['-S', 'mock:1', '-X'])
+
+
+class ShardedWriteBatchTest(WriteTest):
+
+    def setUp(self):
+        WriteTest.setUp(self)
+        backends = {'a:1': MockRedis(), 'b:1': MockRedis(), 'c:1': MockRedis()}
+        old = ShardedRedis(dict((n, backends[n]) for n in ('a:1', 'b:1')),
+                           REDIS_PREFIX)
+        self.pr.be = ShardedRedis(backends, REDIS_PREFIX, previous=old)
+        self.domain = [d for d in ('d%d.com' % i for i in range(0, 100))
+                       if self.pr.be.Moved(REDIS_PREFIX + d) is not None][0]
+        self.key = REDIS_PREFIX + self.domain
+        self.be = self.pr.be.Node(self.key)
+        old.hset(self.key, 'A\t1', '60')
+        old.hset(self.key, 'MX\t10 mx', '60')
+
+    def Journal(self):
+        return [(entry_id, fields['changes'].split('\n'))
+                for be in self.pr.be.backends.values()
+                for entry_id, fields in be.data.get(JOURNAL_KEY, [])]
+
+    def test_delete_while_moving(self):
+        QueryOp(self.pr, self.domain).Query()
+        output = self.Run(DeleteOp(self.pr, self.domain, 'A', None))
+        self.assertEqual(output, ['Deleted 1 records from %s.' % self.domain])
+        self.assertEqual(self.Journal(),
+                         [('1-0', ['DEL\t%s\tA\t1' % self.domain])])
+        self.assertEqual(self.pr.be.hgetall(self.key),
+                         {'MX\t10 mx': '60', 'TXT\tQC': '1'})
+
+    def test_delete_all_uses_merged_view(self):
+        self.Run(DeleteOp(self.pr, self.domain))
+        self.assertEqual(self.Journal(), [('1-0', ['DEL\t%s' % self.domain])])
+        self.assertEqual(self.pr.be.hgetall(self.key), {})
+
+    def test_delete_all_while_moving(self):
+        self.Run(DeleteOp(self.pr, self.domain),
+                 AddOp(self.pr, self.domain, 'A', '2', '60'))
+        self.assertEqual(self.pr.be.hgetall(self.key), {'A\t2': '60'})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+
+"""
+Tests for PyPdnsRedis.sharding, run against MockRedis.
+"""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from PyPdnsRedis.mock import MockRedis
+from PyPdnsRedis.sharding import (HashRing, ShardKey, ShardedRedis, Reshard,
+                                  TOMBSTONE_PREFIX)
+
+PREFIX = 'pdns.'
+DOMAINS = ['domain%d.com' % i for i in range(0, 300)]
+
+
+def Layout(names, backends, previous=None):
+    for name in names:
+        backends.setdefault(name, MockRedis())
+    return ShardedRedis(dict((name, backends[name]) for name in names),
+                        PREFIX, previous=previous)
+
+
+class ShardKeyTest(unittest.TestCase):
+
+    def test_zone_and_wildcards_share_key(self):
+        self.assertEqual(ShardKey('domain.com'), 'domain.com')
+        self.assertEqual(ShardKey('foo.domain.com'), 'domain.com')
+        self.assertEqual(ShardKey('*.domain.com'), 'domain.com')
+        self.assertEqual(ShardKey('*.foo.domain.com'), 'domain.com')
+
+    def test_trailing_dot_and_case(self):
+        self.assertEqual(ShardKey('Foo.Domain.COM.'), 'domain.com')
+
+    def test_zone_labels(self):
+        self.assertEqual(ShardKey('www.domain.co.uk', 3), 'domain.co.uk')
+
+
+class HashRingTest(unittest.TestCase):
+
+    def test_adding_node_only_moves_keys_to_it(self):
+        before = HashRing(['a:1', 'b:1', 'c:1'])
+        after = HashRing(['a:1', 'b:1', 'c:1', 'd:1'])
+        moved = 0
+        for domain in DOMAINS:
+            if before.GetNode(domain) != after.GetNode(domain):
+                self.assertEqual(after.GetNode(domain), 'd:1')
+                moved += 1
+        self.assertTrue(0 < moved < len(DOMAINS) / 2)
+
+    def test_node_order_does_not_matter(self):
+        r1 = HashRing(['a:1', 'b:1'])
+        r2 = HashRing(['b:1', 'a:1'])
+        for domain in DOMAINS:
+            self.assertEqual(r1.GetNode(domain), r2.GetNode(domain))
+
+
+class LayoutTest(unittest.TestCase):
+    """Grow from two shards to three, with one moving domain populated."""
+
+    def setUp(self):
+        self.backends = {}
+        self.old = Layout(['a:1', 'b:1'], self.backends)
+        self.new = Layout(['a:1', 'b:1', 'c:1'], self.backends,
+                          previous=self.old)
+        self.domain = [d for d in DOMAINS
+                       if self.new.Moved(PREFIX + d) is not None][0]
+        self.key = PREFIX + self.domain
+        self.old.hset(self.key, 'A\t1.2.3.4', '300')
+        self.old.hset(self.key, 'MX\t10 mx', '300')
+
+
+class ShardedRedisTest(LayoutTest):
+
+    def test_wildcards_colocated(self):
+        for domain in DOMAINS:
+            node = self.new.NodeName(PREFIX + domain)
+            self.assertEqual(self.new.NodeName(PREFIX + '*.' + domain), node)
+            self.assertEqual(self.new.NodeName(PREFIX + 'www.' + domain), node)
+
+    def test_moved_compares_node_names(self):
+        stay = [d for d in DOMAINS
+                if self.old.NodeName(PREFIX + d) == self.new.NodeName(PREFIX + d)]
+        self.assertTrue(stay)
+        self.assertEqual(self.new.Moved(PREFIX + stay[0]), None)
+        self.assertEqual(self.new.Moved(self.key), self.old.Node(self.key))
+
+    def test_read_survives_counter_write(self):
+        self.new.hincrby(self.key, 'TXT\tQC', 1)
+        self.assertEqual(sorted(self.new.hgetall(self.key).keys()),
+                         ['A\t1.2.3.4', 'MX\t10 mx', 'TXT\tQC'])
+        self.assertEqual(self.new.hget(self.key, 'A\t1.2.3.4'), '300')
+
+    def test_new_fields_win(self):
+        self.new.hset(self.key, 'A\t1.2.3.4', '60')
+        self.new.hset(self.key, 'TXT\thello', '60')
+        data = self.new.hgetall(self.key)
+        self.assertEqual(data['A\t1.2.3.4'], '60')
+        self.assertEqual(data['MX\t10 mx'], '300')
+        self.assertEqual(data['TXT\thello'], '60')
+
+    def test_hdel_while_moving(self):
+        self.new.hdel(self.key, 'MX\t10 mx')
+        self.assertEqual(list(self.new.hgetall(self.key).keys()),
+                         ['A\t1.2.3.4'])
+        self.assertEqual(self.new.hget(self.key, 'MX\t10 mx'), None)
+
+    def test_delete_while_moving(self):
+        self.new.delete(self.key)
+        self.new.hset(self.key, 'A\t5.6.7.8', '60')
+        self.assertEqual(self.new.hgetall(self.key), {'A\t5.6.7.8': '60'})
+
+
+class ReshardTest(LayoutTest):
+
+    def test_reshard_moves_all_fields(self):
+        for domain in DOMAINS:
+            self.old.hset(PREFIX + domain, 'A\t1.2.3.4', '300')
+        self.old.hset(self.key, 'MX\t10 mx', '300')
+        self.new.hset(self.key, 'A\t1.2.3.4', '60')
+
+        moved = Reshard(self.old, self.new, pause=0)
+        self.assertTrue(0 < moved < len(DOMAINS))
+
+        for domain in DOMAINS:
+            key = PREFIX + domain
+            self.assertTrue(self.new.Node(key).hget(key, 'A\t1.2.3.4'))
+            if self.new.Moved(key) is not None:
+                self.assertEqual(self.old.Node(key).hgetall(key), {})
+        self.assertEqual(self.new.Node(self.key).hgetall(self.key),
+                         {'A\t1.2.3.4': '60', 'MX\t10 mx': '300'})
+
+    def test_reshard_keeps_deletions(self):
+        self.new.hdel(self.key, 'MX\t10 mx')
+        self.old.Node(self.key).hset(self.key, 'MX\t10 mx', '300')
+        Reshard(self.old, self.new, pause=0)
+        self.assertEqual(self.new.Node(self.key).hgetall(self.key),
+                         {'A\t1.2.3.4': '300'})
+
+        for be in self.backends.values():
+            self.assertEqual(list(be.scan_iter(TOMBSTONE_PREFIX + '*')), [])
+
+    def test_tombstones_do_not_outlive_reshard(self):
+        Reshard(self.old, self.new, pause=0)
+        # Clients still running with -O delete and re-add the domain.
+        self.new.delete(self.key)
+        self.new.hset(self.key, 'A\t5.6.7.8', '60')
+
+        three = Layout(['a:1', 'b:1', 'c:1'], self.backends)
+        Reshard(three, Layout(['a:1', 'b:1'], self.backends, previous=three),
+                pause=0)
+        regrow = Layout(['a:1', 'b:1', 'c:1'], self.backends,
+                        previous=Layout(['a:1', 'b:1'], self.backends))
+        self.assertEqual(regrow.hgetall(self.key), {'A\t5.6.7.8': '60'})
+        Reshard(regrow.previous, regrow, pause=0)
+        self.assertEqual(regrow.hgetall(self.key), {'A\t5.6.7.8': '60'})
+
+    def test_query_counts_are_added(self):
+        self.old.hset(self.key, 'TXT\tQC', '500')
+        self.new.hincrby(self.key, 'TXT\tQC', 1)
+        self.assertEqual(self.new.hget(self.key, 'TXT\tQC'), '501')
+        self.assertEqual(self.new.hgetall(self.key)['TXT\tQC'], '501')
+        Reshard(self.old, self.new, pause=0)
+        self.assertEqual(self.new.Node(self.key).hget(self.key, 'TXT\tQC'),
+                         '501')
+
+    def test_reshard_races_client_delete(self):
+        dst = self.new.Node(self.key)
+        smembers = dst.smembers
+
+        def DeleteThenSmembers(key):
+            # The client deletes after Reshard has read the source hash.
+            dst.smembers = smembers
+            self.new.hdel(self.key, 'MX\t10 mx')
+            return smembers(key)
+        dst.smembers = DeleteThenSmembers
+
+        Reshard(self.old, self.new, pause=0)
+        self.assertEqual(dst.hgetall(self.key), {'A\t1.2.3.4': '300'})
+
+
+if __name__ == '__main__':
+    unittest.main()